@@ -1,12 +1,18 @@
 import streamlit as st
 import google.generativeai as genai
 from PIL import Image
-import PyPDF2
-import tempfile
+import pypdfium2 as pdfium
+import io
 import os
+import tempfile
+import contextlib
 from google.api_core import exceptions
 from dotenv import load_dotenv
 import time
+import hashlib
+import threading
+from pathlib import Path
+from itertools import islice
 
 load_dotenv()
 
@@ -16,31 +22,163 @@ if not api_key:
     st.error("Gemini API key not found. Please set the GEMINI_API_KEY environment variable.")
     st.stop()
 
-genai.configure(api_key=api_key)
-model = genai.GenerativeModel('gemini-1.5-flash')
+MODEL_NAME = 'gemini-1.5-flash'
+
+@st.cache_resource(show_spinner=False)
+def get_model(api_key):
+    # Built once per process rather than on every Streamlit rerun
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(MODEL_NAME)
+
+model = get_model(api_key)
 
 MAX_RETRIES = 3
 RETRY_DELAY = 2  # seconds
+MIN_PDF_TEXT_LENGTH = 50  # characters; below this the text layer is treated as missing
+# Lab reports rarely run past a few dozen pages; stop before degenerate inputs eat the budget
+MAX_PDF_PAGES = int(os.getenv("MAX_PDF_PAGES", "50"))
+MAX_PDF_CHARS = int(os.getenv("MAX_PDF_CHARS", "200000"))
+# PDFium is not thread-safe and Streamlit runs each session in its own thread
+PDFIUM_LOCK = threading.Lock()
+CACHE_DIR = Path(os.getenv("GEMINI_CACHE_DIR", ".gemini_cache"))
+# Cached analyses are medical data stored in plaintext, so keep them bounded in both age and count
+CACHE_TTL = int(os.getenv("GEMINI_CACHE_TTL", str(7 * 24 * 3600)))  # seconds
+CACHE_MAX_ENTRIES = int(os.getenv("GEMINI_CACHE_MAX_ENTRIES", "100"))
+# Finish reasons that mean the safety filter withheld content, as opposed to the answer just running out
+SAFETY_FINISH_REASONS = {"SAFETY", "BLOCKLIST", "PROHIBITED_CONTENT", "SPII"}
+
+def analysis_cache_path(prompt, content, content_type, image_bytes=None):
+    # The model and prompt are part of the key, so changing either invalidates old entries
+    hasher = hashlib.sha256(f"{MODEL_NAME}\n{prompt}\n{content_type}\n".encode())
+    if content_type == "image":
+        # Hash the uploaded file rather than decoding and hashing every pixel
+        hasher.update(image_bytes)
+    else:  # text
+        # Extraction can differ only in surrounding whitespace between parsers
+        hasher.update(content.strip().encode())
+    return CACHE_DIR / hasher.hexdigest()
+
+def read_cached_analysis(cache_path):
+    try:
+        if time.time() - cache_path.stat().st_mtime > CACHE_TTL:
+            cache_path.unlink(missing_ok=True)
+            return None
+        return cache_path.read_text(encoding="utf-8")
+    except (OSError, UnicodeDecodeError):
+        # Treat an unreadable entry as a miss rather than failing the analysis
+        return None
+
+def write_cached_analysis(cache_path, analysis):
+    tmp_path = None
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # Write to a temp file and rename it into place, so other sessions never read a partial entry
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=CACHE_DIR, suffix=".tmp", delete=False) as tmp_file:
+            tmp_path = tmp_file.name
+            tmp_file.write(analysis)
+        os.replace(tmp_path, cache_path)
+        tmp_path = None
+        prune_analysis_cache()
+    except OSError:
+        # A cache failure shouldn't cost the user an analysis they already have
+        if tmp_path is not None:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_path)
+
+def prune_analysis_cache():
+    now = time.time()
+    entries = []
+    for path in CACHE_DIR.iterdir():
+        try:
+            mtime = path.stat().st_mtime
+        except FileNotFoundError:
+            continue
+        if path.suffix == ".tmp":
+            # Another session may still be writing it; once stale it's a leftover from a failed write
+            if now - mtime > CACHE_TTL:
+                path.unlink(missing_ok=True)
+            continue
+        entries.append((mtime, path))
+
+    entries.sort(reverse=True)
+    for index, (mtime, path) in enumerate(entries):
+        if index >= CACHE_MAX_ENTRIES or now - mtime > CACHE_TTL:
+            path.unlink(missing_ok=True)
+
+def stream_text(response, stop_issues):
+    # Records why the answer stopped early in stop_issues: "blocked" or the finish reason name
+    for chunk in response:
+        if chunk.prompt_feedback.block_reason:
+            stop_issues.add("blocked")
+            continue
+        if not chunk.candidates:
+            continue
+
+        candidate = chunk.candidates[0]
+        finish_reason = getattr(candidate.finish_reason, "name", "OTHER")
+        if finish_reason in SAFETY_FINISH_REASONS:
+            stop_issues.add("blocked")
+        elif finish_reason not in ("FINISH_REASON_UNSPECIFIED", "STOP"):
+            stop_issues.add(finish_reason)
+
+        # The closing chunk often has no parts, and chunk.text raises on those
+        if not candidate.content.parts:
+            continue
+        try:
+            text = chunk.text
+        except ValueError:
+            continue
+        yield text
 
-def analyze_medical_report(content, content_type):
+def analyze_medical_report(content, content_type, image_bytes=None):
     prompt = "Analyze this medical report concisely. Provide key findings, diagnoses, and recommendations:"
-    
+    output = st.empty()
+
+    cache_path = analysis_cache_path(prompt, content, content_type, image_bytes)
+    analysis = read_cached_analysis(cache_path)
+    if analysis is not None:
+        output.write(analysis)
+        return analysis
+
     for attempt in range(MAX_RETRIES):
         try:
             if content_type == "image":
-                response = model.generate_content([prompt, content])
+                response = model.generate_content([prompt, content], stream=True)
             else:  # text
                 # Gemini 1.5 Flash can handle larger inputs, so we'll send the full text
-                response = model.generate_content(f"{prompt}\n\n{content}")
-            
-            return response.text
+                response = model.generate_content(f"{prompt}\n\n{content}", stream=True)
+
+            # Render chunks as they arrive instead of waiting for the whole response
+            stop_issues = set()
+            analysis = output.write_stream(stream_text(response, stop_issues))
+            if not analysis.strip():
+                output.empty()
+                if "blocked" in stop_issues:
+                    st.error("The AI service returned no analysis for this report because it was blocked by the safety filter.")
+                else:
+                    st.error("The AI service returned no analysis for this report.")
+                analysis = fallback_analysis(content, content_type)
+                output.write(analysis)
+                return analysis
+
+            # Don't cache a partial answer; the next attempt may come back complete
+            if "blocked" in stop_issues:
+                st.warning("Part of the AI response was withheld by the safety filter, so this analysis may be incomplete.")
+            elif stop_issues:
+                st.warning(f"The AI response was cut short ({', '.join(sorted(stop_issues))}), so this analysis may be incomplete.")
+            else:
+                write_cached_analysis(cache_path, analysis)
+            return analysis
         except exceptions.GoogleAPIError as e:
+            output.empty()
             if attempt < MAX_RETRIES - 1:
                 st.warning(f"An error occurred. Retrying in {RETRY_DELAY} seconds... (Attempt {attempt + 1}/{MAX_RETRIES})")
                 time.sleep(RETRY_DELAY)
             else:
                 st.error(f"Failed to analyze the report after {MAX_RETRIES} attempts. Error: {str(e)}")
-                return fallback_analysis(content, content_type)
+                analysis = fallback_analysis(content, content_type)
+                output.write(analysis)
+                return analysis
 
 def fallback_analysis(content, content_type):
     st.warning("Using fallback analysis method due to API issues.")
@@ -57,12 +195,60 @@ def fallback_analysis(content, content_type):
         5. Note: This is a simplified analysis due to temporary unavailability of the AI service. For a comprehensive analysis, please try again later.
         """
 
-def extract_text_from_pdf(pdf_file):
-    pdf_reader = PyPDF2.PdfReader(pdf_file)
-    text = ""
-    for page in pdf_reader.pages:
-        text += page.extract_text()
-    return text
+def looks_garbled(text):
+    # Broken font encodings come out as mostly symbols/control characters
+    stripped = "".join(text.split())
+    if len(stripped) < MIN_PDF_TEXT_LENGTH:
+        return True
+    readable = sum(ch.isalnum() or ch in ".,:;%()/-" for ch in stripped)
+    return readable / len(stripped) < 0.5
+
+def join_pages(page_texts):
+    # Pulls pages from the generator one at a time, so pages after the cap are never extracted
+    parts = []
+    total_chars = 0
+    for page_text in page_texts:
+        if total_chars + len(page_text) > MAX_PDF_CHARS:
+            parts.append(page_text[:MAX_PDF_CHARS - total_chars])
+            return "".join(parts), True
+        parts.append(page_text)
+        total_chars += len(page_text)
+    return "".join(parts), False
+
+def extract_text_with_pdfium(buf):
+    with PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(buf)
+        try:
+            n_pages = len(pdf)
+            text, truncated = join_pages(
+                pdf[i].get_textpage().get_text_range() for i in range(min(n_pages, MAX_PDF_PAGES))
+            )
+            return text, truncated or n_pages > MAX_PDF_PAGES
+        finally:
+            pdf.close()
+
+def extract_text_with_pypdf2(buf):
+    # Only needed for the rare garbled-text fallback, so keep it off the startup path
+    import PyPDF2
+
+    pdf_reader = PyPDF2.PdfReader(io.BytesIO(buf))
+    text, truncated = join_pages(page.extract_text() for page in islice(pdf_reader.pages, MAX_PDF_PAGES))
+    return text, truncated or len(pdf_reader.pages) > MAX_PDF_PAGES
+
+# Extracted report text is medical data too, so bound it like the on-disk analysis cache
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL)
+def extract_text_from_pdf(pdf_bytes):
+    try:
+        text, truncated = extract_text_with_pdfium(pdf_bytes)
+    except pdfium.PdfiumError:
+        text, truncated = "", False
+
+    # pdfium is much faster, but PyPDF2 occasionally recovers text it can't decode
+    if looks_garbled(text):
+        fallback_text, fallback_truncated = extract_text_with_pypdf2(pdf_bytes)
+        if len(fallback_text.strip()) > len(text.strip()):
+            text, truncated = fallback_text, fallback_truncated
+    return text, truncated
 
 def main():
     st.title("AI-driven Medical Report Analyzer")
@@ -73,20 +259,14 @@ def main():
     if file_type == "Image":
         uploaded_file = st.file_uploader("Choose a medical report image", type=["jpg", "jpeg", "png"])
         if uploaded_file is not None:
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as tmp_file:
-                tmp_file.write(uploaded_file.getvalue())
-                tmp_file_path = tmp_file.name
-
-            image = Image.open(tmp_file_path)
+            image_bytes = uploaded_file.getvalue()
+            image = Image.open(io.BytesIO(image_bytes))
             st.image(image, caption="Uploaded Medical Report", use_column_width=True)
 
             if st.button("Analyze Image Report"):
                 with st.spinner("Analyzing the medical report image..."):
-                    analysis = analyze_medical_report(image, "image")
                     st.subheader("Analysis Results:")
-                    st.write(analysis)
-
-            os.unlink(tmp_file_path)
+                    analyze_medical_report(image, "image", image_bytes)
 
     else:  # PDF
         uploaded_file = st.file_uploader("Choose a medical report PDF", type=["pdf"])
@@ -95,18 +275,12 @@ def main():
 
             if st.button("Analyze PDF Report"):
                 with st.spinner("Analyzing the medical report PDF..."):
-                    with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as tmp_file:
-                        tmp_file.write(uploaded_file.getvalue())
-                        tmp_file_path = tmp_file.name
+                    pdf_text, truncated = extract_text_from_pdf(uploaded_file.getvalue())
+                    if truncated:
+                        st.warning(f"This report is longer than {MAX_PDF_PAGES} pages or {MAX_PDF_CHARS:,} characters. Only the first part was analyzed, so results later in the document may be missing.")
 
-                    with open(tmp_file_path, 'rb') as pdf_file:
-                        pdf_text = extract_text_from_pdf(pdf_file)
-
-                    analysis = analyze_medical_report(pdf_text, "text")
                     st.subheader("Analysis Results:")
-                    st.write(analysis)
-
-                    os.unlink(tmp_file_path)
+                    analyze_medical_report(pdf_text, "text")
 
 if __name__ == "__main__":
     main()